@@ -28,28 +28,47 @@ class MultiHeadAttention(nn.Module):
         init.xavier_normal(self.w_ks)
         init.xavier_normal(self.w_vs)
 
-    def forward(self, q, k, v, attn_mask=None):
+    def project_kv(self, k, v):
+        """ Project keys and values for each head, result size = n_head x mb_size x len x d """
+        n_head = self.n_head
+
+        mb_size, len_k, d_model = k.size()
+        mb_size, len_v, d_model = v.size()
+
+        k_s = k.repeat(n_head, 1, 1).view(n_head, -1, d_model) # n_head x (mb_size*len_k) x d_model
+        v_s = v.repeat(n_head, 1, 1).view(n_head, -1, d_model) # n_head x (mb_size*len_v) x d_model
+
+        k_s = torch.bmm(k_s, self.w_ks).view(n_head, mb_size, len_k, self.d_k)   # n_head x mb_size x len_k x d_k
+        v_s = torch.bmm(v_s, self.w_vs).view(n_head, mb_size, len_v, self.d_v)   # n_head x mb_size x len_v x d_v
+
+        return k_s, v_s
+
+    def forward(self, q, k, v, attn_mask=None, kv=None):
         d_k, d_v = self.d_k, self.d_v
         n_head = self.n_head
 
         residual = q
 
         mb_size, len_q, d_model = q.size()
-        mb_size, len_k, d_model = k.size()
-        mb_size, len_v, d_model = v.size()
+
+        # keys and values may be projected ahead of time, e.g. encoder outputs while decoding
+        if kv is None:
+            kv = self.project_kv(k, v)
+        k_s, v_s = kv
+        len_k, len_v = k_s.size(2), v_s.size(2)
 
         # treat as a (n_head) size batch
         q_s = q.repeat(n_head, 1, 1).view(n_head, -1, d_model) # n_head x (mb_size*len_q) x d_model
-        k_s = k.repeat(n_head, 1, 1).view(n_head, -1, d_model) # n_head x (mb_size*len_k) x d_model
-        v_s = v.repeat(n_head, 1, 1).view(n_head, -1, d_model) # n_head x (mb_size*len_v) x d_model
 
         # treat the result as a (n_head * mb_size) size batch
         q_s = torch.bmm(q_s, self.w_qs).view(-1, len_q, d_k)   # (n_head*mb_size) x len_q x d_k
-        k_s = torch.bmm(k_s, self.w_ks).view(-1, len_k, d_k)   # (n_head*mb_size) x len_k x d_k
-        v_s = torch.bmm(v_s, self.w_vs).view(-1, len_v, d_v)   # (n_head*mb_size) x len_v x d_v
+        k_s = k_s.contiguous().view(-1, len_k, d_k)             # (n_head*mb_size) x len_k x d_k
+        v_s = v_s.contiguous().view(-1, len_v, d_v)             # (n_head*mb_size) x len_v x d_v
 
         # perform attention, result size = (n_head * mb_size) x len_q x d_v
-        outputs, attns = self.attention(q_s, k_s, v_s, attn_mask=attn_mask.repeat(n_head, 1, 1))
+        if attn_mask is not None:
+            attn_mask = attn_mask.repeat(n_head, 1, 1)
+        outputs, attns = self.attention(q_s, k_s, v_s, attn_mask=attn_mask)
 
         # back to original mb_size batch, result size = mb_size x len_q x (n_head*d_v)
         outputs = torch.cat(torch.split(outputs, mb_size, dim=0), dim=-1)
@@ -103,6 +122,21 @@ class DecoderLayer(nn.Module):
         dec_output = self.pos_ffn(dec_output)
         return dec_output, dec_slf_attn, dec_enc_attn
 
+    def step(self, dec_input, enc_kv, slf_kv, slf_write_mask, slf_attn_mask=None, dec_enc_attn_mask=None):
+        """ Decode the newest position, writing its self-attention keys/values into the cache
+
+        slf_kv holds keys/values for every target position, slf_write_mask selects the position
+        decoded by this step and slf_attn_mask hides those not decoded yet.
+        """
+        slf_k, slf_v = self.slf_attn.project_kv(dec_input, dec_input)
+        slf_k = torch.where(slf_write_mask, slf_k, slf_kv[0])
+        slf_v = torch.where(slf_write_mask, slf_v, slf_kv[1])
+
+        dec_output, _ = self.slf_attn(dec_input, None, None, attn_mask=slf_attn_mask, kv=(slf_k, slf_v))
+        dec_output, _ = self.enc_attn(dec_output, None, None, attn_mask=dec_enc_attn_mask, kv=enc_kv)
+        dec_output = self.pos_ffn(dec_output)
+        return dec_output, (slf_k, slf_v)
+
 
 class MultiDecoderLayer(nn.Module):
     def __init__(self, d_model, d_inner_hid, n_head, d_k, d_v, dropout=0.1):
@@ -126,6 +126,46 @@ class Decoder(nn.Module):
         else:
             return dec_output,
 
+    def project_enc_kv(self, enc_output):
+        """ Project the encoder output to the keys and values attended to by each layer """
+        return [dec_layer.enc_attn.project_kv(enc_output, enc_output) for dec_layer in self.layer_stack]
+
+    def init_slf_kv(self, enc_kv):
+        """ Allocate self-attention keys/values and padding flags for every target position, alongside enc_kv """
+        return [tuple(t.new_zeros(t.size(0), t.size(1), self.n_max_seq, t.size(3)) for t in kv) +
+                (kv[0].new_zeros(1, kv[0].size(1), self.n_max_seq, 1, dtype=torch.bool),) for kv in enc_kv]
+
+    def forward_with_kv(self, tgt_seq, tgt_pos, src_seq, enc_kv, slf_kv):
+        """ Decode only the newest target position against cached keys and values
+
+        enc_kv holds the per-layer encoder keys/values from `project_enc_kv`, slf_kv the keys, values
+        and padding flags of the decoded positions from `init_slf_kv` or the last call. Every target
+        position has a slot in slf_kv so that each step runs on tensors of the same size.
+        """
+        dec_input = self.tgt_word_emb(tgt_seq)
+        dec_input += self.position_enc(tgt_pos)
+
+        # the newest position is written into its slot, later slots and padding are not attended to
+        mb_size, len_q = tgt_pos.size()
+        cache_pos = torch.arange(1, self.n_max_seq + 1, device=tgt_pos.device).view(1, 1, -1)
+        dec_slf_write_mask = cache_pos.eq(tgt_pos[:, -1:].unsqueeze(2)).view(1, mb_size, -1, 1)
+        dec_slf_pad = torch.where(
+            dec_slf_write_mask, tgt_seq[:, -1:].eq(PAD).view(1, mb_size, 1, 1), slf_kv[0][2])
+        dec_slf_attn_mask = cache_pos.gt(tgt_pos.unsqueeze(2)) | dec_slf_pad.view(mb_size, 1, -1)
+
+        dec_enc_attn_pad_mask = get_attn_padding_mask(tgt_seq, src_seq)
+
+        dec_output = dec_input
+        dec_slf_kv = []
+        for dec_layer, layer_enc_kv, layer_slf_kv in zip(self.layer_stack, enc_kv, slf_kv):
+            dec_output, layer_slf_kv = dec_layer.step(
+                dec_output, layer_enc_kv, layer_slf_kv, dec_slf_write_mask,
+                slf_attn_mask=dec_slf_attn_mask,
+                dec_enc_attn_mask=dec_enc_attn_pad_mask)
+            dec_slf_kv.append(layer_slf_kv + (dec_slf_pad,))
+
+        return dec_output, dec_slf_kv
+
 
 class Transformer(nn.Module):
     """ A sequence to sequence model with attention mechanism. """
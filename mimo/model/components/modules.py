@@ -42,9 +42,6 @@ class LayerNormalization(nn.Module):
         self.b_2 = nn.Parameter(torch.zeros(d_hid), requires_grad=True)
 
     def forward(self, z):
-        if z.size(1) == 1:
-            return z
-
         mu = torch.mean(z, keepdim=True, dim=-1)
         sigma = torch.std(z, keepdim=True, dim=-1)
         ln_out = (z - mu.expand_as(z)) / (sigma.expand_as(z) + self.eps)
@@ -72,7 +69,7 @@ class ScaledDotProductAttention(nn.Module):
     """ Scaled Dot-Product Attention """
     def __init__(self, d_model, attn_dropout=0.1):
         super(ScaledDotProductAttention, self).__init__()
-        self.temper = np.power(d_model, 0.5)
+        self.temper = float(np.power(d_model, 0.5))
         self.dropout = nn.Dropout(attn_dropout)
         self.softmax = BottleSoftmax()
 
@@ -85,7 +82,7 @@ class ScaledDotProductAttention(nn.Module):
                     'with Attention logit tensor shape ' \
                     '{}.'.format(attn_mask.size(), attn.size())
 
-            attn.data.masked_fill_(attn_mask, -float('inf'))
+            attn = attn.masked_fill(attn_mask, -float('inf'))
 
         attn = self.softmax(attn)
         attn = self.dropout(attn)
@@ -51,7 +51,7 @@ class Beam(object):
 
         # bestScoresId is flattened beam x word array, so calculate which
         # word and beam each score came from
-        prev_k = best_scores_id / num_words
+        prev_k = best_scores_id // num_words
         self.prev_ks.append(prev_k)
         self.next_ys.append(best_scores_id - prev_k * num_words)
 
@@ -93,3 +93,111 @@ class Beam(object):
 class Greedy(Beam):
     def __init__(self, cuda=False):
         super().__init__(1, cuda)
+
+
+class BeamSet(object):
+    """ Beam search over a batch of instances, with all of the state kept on device """
+    def __init__(self, size, inits, max_len, cuda=False):
+        self.size = size
+
+        self.tt = torch.cuda if cuda else torch
+
+        inits = self.tt.LongTensor(inits) if isinstance(inits, list) else inits
+        batch_size = inits.size(0)
+
+        # The instances being decoded in batch order, finished ones are kept until compacted.
+        self.active_idxs = self.tt.LongTensor(list(range(batch_size)))
+        self.n_remaining = batch_size
+
+        # The score for each translation on the beam, only the first beam is extended at first.
+        self.scores = self.tt.FloatTensor(batch_size, size).fill_(-float('inf'))
+        self.scores[:, 0] = 0
+
+        # The backpointers of beams which extend themselves, as finished instances do.
+        self.beam_idxs = torch.arange(size, device=self.scores.device)
+
+        # The outputs of every beam at each time-step, size: batch x beam x (max_len + 1), all beams
+        # start from the initial token so that none of them attends to padding alone.
+        self.tokens = self.tt.LongTensor(batch_size, size, max_len + 1).fill_(PAD)
+        self.tokens[:, :, 0] = inits.unsqueeze(1)
+        self.length = 1
+
+        # The number of outputs of each instance, which stops growing once it is done.
+        self.lengths = self.tt.LongTensor(batch_size).zero_()
+        self.finished = self.tt.BoolTensor(batch_size).fill_(False)
+
+    @property
+    def done(self):
+        return self.n_remaining == 0
+
+    def get_current_state(self):
+        """ Get the outputs for the current timestep of the active instances, size: batch x beam """
+        return self.tokens[:, :, self.length - 1].index_select(0, self.active_idxs)
+
+    def advance(self, word_lk, word_idxs):
+        """ Update the active instances from the batch x beam x words scores of the words word_idxs
+
+        Returns the backpointers of every beam in the batch, the batch indices of the instances
+        which have not finished, and whether any beam extends another beam than itself. Finished
+        instances are left as they are.
+        """
+        n_insts, size, num_words = word_lk.size()
+        scores = self.scores.index_select(0, self.active_idxs)
+        finished = self.finished.index_select(0, self.active_idxs)
+
+        # Sum the previous scores and take the best of all beams of each instance.
+        beam_lk = (word_lk + scores.unsqueeze(2)).view(n_insts, -1)
+        best_scores, best_scores_id = beam_lk.topk(size, 1, True, True)
+
+        # bestScoresId is flattened beam x word array, so calculate which
+        # word and beam each score came from
+        origins = best_scores_id // num_words
+        next_ys = word_idxs.view(n_insts, -1).gather(1, best_scores_id)
+
+        # Finished instances keep their beams.
+        origins = torch.where(finished.unsqueeze(1), self.beam_idxs, origins)
+        best_scores = torch.where(finished.unsqueeze(1), scores, best_scores)
+        next_ys = next_ys.masked_fill(finished.unsqueeze(1), PAD)
+
+        # each beam continues the outputs of the beam it originated from
+        tokens = self.tokens.index_select(0, self.active_idxs)
+        tokens = tokens.gather(1, origins.unsqueeze(2).expand_as(tokens))
+        tokens[:, :, self.length] = next_ys
+        self.length += 1
+
+        self.tokens.index_copy_(0, self.active_idxs, tokens)
+        self.scores.index_copy_(0, self.active_idxs, best_scores)
+        self.lengths.index_add_(0, self.active_idxs, (~finished).long())
+
+        # End condition is when top-of-beam is EOS.
+        finished = finished | next_ys[:, 0].eq(EOS)
+        self.finished.index_copy_(0, self.active_idxs, finished)
+
+        # The unfinished instances are found by nonzero, the one transfer to the host of each step.
+        # It is given n_insts + 1 more flags set if any beam switched parent, which its size shows.
+        reordered = origins.ne(self.beam_idxs).any()
+        idxs = torch.cat([~finished, reordered.expand(n_insts + 1)]).nonzero().view(-1)
+        reordered = idxs.size(0) > n_insts
+
+        active_inst_idxs = idxs[:idxs.size(0) - (n_insts + 1) if reordered else idxs.size(0)]
+        self.n_remaining = active_inst_idxs.size(0)
+        return origins, active_inst_idxs, reordered
+
+    def finish(self, inst_idxs):
+        """ Mark instances as finished before they are decoded, they are kept as they are """
+        self.finished.index_fill_(0, inst_idxs, True)
+
+    def compact(self, active_inst_idxs):
+        """ Only keep the given instances of the batch """
+        self.active_idxs = self.active_idxs.index_select(0, active_inst_idxs)
+
+    def get_n_best(self, n_best):
+        """ Get the n best hypotheses and their scores for every instance """
+        scores, idxs = torch.sort(self.scores, 1, True)
+        scores, idxs = scores[:, :n_best], idxs[:, :n_best]
+        tokens = self.tokens.gather(1, idxs.unsqueeze(2).expand(-1, -1, self.tokens.size(2)))
+
+        all_hyp = [
+            [hyp[1:length + 1] for hyp in hyps]
+            for hyps, length in zip(tokens.tolist(), self.lengths.tolist())]
+        return all_hyp, scores.tolist()
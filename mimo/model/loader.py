@@ -1,5 +1,7 @@
 import random
+from itertools import chain
 import numpy as np
+import pyarrow as pa
 import torch
 from torch.autograd import Variable
 from mimo.model.components import PAD
@@ -7,15 +9,76 @@ from mimo.model.preprocess import target_config
 from torch.autograd import Variable
 
 
+class PackedSequences(object):
+    """ Sequences of word indices packed into one array, along with the offsets where each starts """
+    def __init__(self, tokens, offsets, valid):
+        self.tokens = tokens
+        self.offsets = offsets
+
+        # missing sequences are empty and not valid
+        self.valid = valid
+
+    @classmethod
+    def from_lists(cls, insts):
+        """ Pack a list of sequences, None for those which are missing """
+        lengths = [0 if inst is None else len(inst) for inst in insts]
+        offsets = np.cumsum([0] + lengths)
+        tokens = np.fromiter(chain.from_iterable(inst for inst in insts if inst is not None), np.int64, offsets[-1])
+        return cls(tokens, offsets, np.array([inst is not None for inst in insts], dtype=bool))
+
+    @classmethod
+    def from_arrow(cls, array):
+        """ Wrap a list array of sequences, the tokens and offsets are not copied """
+        if isinstance(array, pa.ChunkedArray):
+            array = array.chunk(0) if array.num_chunks == 1 else array.combine_chunks()
+        return cls(array.values.to_numpy(), array.offsets.to_numpy(), array.is_valid().to_numpy(zero_copy_only=False))
+
+    def __len__(self):
+        return len(self.valid)
+
+    def pad(self, idxs):
+        """ Pad the sequences at idxs to the longest of them, size: len(idxs) x max_len """
+        starts = self.offsets[idxs]
+        lengths = self.offsets[idxs + 1] - starts
+        positions = np.arange(lengths.max())
+        in_seq = positions < lengths[:, None]
+
+        inst_data = np.full(in_seq.shape, PAD, dtype=np.int64)
+        inst_data[in_seq] = self.tokens[(starts[:, None] + positions)[in_seq]]
+        return inst_data
+
+
+def pack_sequences(insts):
+    if isinstance(insts, PackedSequences):
+        return insts
+    if isinstance(insts, (pa.Array, pa.ChunkedArray)):
+        return PackedSequences.from_arrow(insts)
+    return PackedSequences.from_lists(insts)
+
+
+def pack_targets(tgt_insts):
+    """ Pack the sequences of each target, given either by instance or by target """
+    if isinstance(tgt_insts, dict):
+        return {k: pack_sequences(insts) for k, insts in tgt_insts.items()}
+    targets = list(dict.fromkeys(k for tgts in tgt_insts for k in tgts))
+    return {k: PackedSequences.from_lists([tgts.get(k) for tgts in tgt_insts]) for k in targets}
+
+
 class MimoDataLoader(object):
     def __init__(self, src_word2idx, tgt_word2idx, src_insts=None, tgt_insts=None,
                  cuda=True, batch_size=64, shuffle=True, test=False, max_iters_per_epoch=None):
+        """ Sequences are lists of word indices, or arrow list arrays such as those of load_dataset
 
-        assert src_insts
+        Targets are given either as a dict of sequences by target for each instance, or as the
+        sequences of each target, with missing ones None or null.
+        """
+        assert src_insts is not None
+        src_insts = pack_sequences(src_insts)
         assert len(src_insts) >= batch_size, 'num_inst(%i) < batch_size(%i)' % (len(src_insts), batch_size)
 
-        if tgt_insts:
-            assert len(src_insts) == len(tgt_insts)
+        if tgt_insts is not None:
+            tgt_insts = pack_targets(tgt_insts)
+            assert all(len(src_insts) == len(insts) for insts in tgt_insts.values())
 
         self.cuda = cuda
         self.test = test
@@ -30,6 +93,9 @@ class MimoDataLoader(object):
         self._src_insts = src_insts
         self._tgt_insts = tgt_insts
 
+        # instances are batched in this order, which is shuffled rather than the instances
+        self._order = list(range(len(src_insts)))
+
         src_idx2word = {idx:word for word, idx in src_word2idx.items()}
         tgt_idx2word = {k: {idx: word for word, idx in word2idx.items()} for k, word2idx in tgt_word2idx.items()}
 
@@ -75,12 +141,7 @@ class MimoDataLoader(object):
         return self._tgt_idx2word
 
     def shuffle(self):
-        if self._tgt_insts:
-            paired_insts = list(zip(self._src_insts, self._tgt_insts))
-            random.shuffle(paired_insts)
-            self._src_insts, self._tgt_insts = zip(*paired_insts)
-        else:
-            random.shuffle(self._src_insts)
+        random.shuffle(self._order)
 
     def __iter__(self):
         return self
@@ -93,19 +154,14 @@ class MimoDataLoader(object):
 
     def next(self):
         """ Get the next batch """
-        def pad_to_longest(insts):
-            max_len = max(len(inst) for inst in insts)
+        def pad_to_longest(insts, idxs):
+            inst_data = insts.pad(idxs)
 
-            inst_data = np.array([
-                inst + [PAD] * (max_len - len(inst))
-                for inst in insts])
+            positions = np.arange(1, inst_data.shape[1] + 1)
+            inst_position = np.where(inst_data != PAD, positions, 0)
 
-            inst_position = np.array([
-                [pos_i+1 if w_i != PAD else 0 for pos_i, w_i in enumerate(inst)]
-                for inst in inst_data])
-
-            inst_data_tensor = Variable(torch.LongTensor(inst_data), volatile=self.test)
-            inst_position_tensor = Variable(torch.LongTensor(inst_position), volatile=self.test)
+            inst_data_tensor = Variable(torch.from_numpy(inst_data), volatile=self.test)
+            inst_position_tensor = Variable(torch.from_numpy(inst_position), volatile=self.test)
 
             if self.cuda:
                 inst_data_tensor = inst_data_tensor.cuda()
@@ -118,23 +174,17 @@ class MimoDataLoader(object):
 
             start_idx = batch_idx * self._batch_size
             end_idx = (batch_idx + 1) * self._batch_size
-            src_insts = self._src_insts[start_idx:end_idx]
+            idxs = np.array(self._order[start_idx:end_idx])
 
             if not self._tgt_insts:
-                return pad_to_longest(src_insts)
+                return pad_to_longest(self._src_insts, idxs)
             else:
-                tgt_insts = self._tgt_insts[start_idx:end_idx]
-
-                tgt_insts_by_k = {}
-                src_idxs_by_k = {}
-                for i, (src, tgts) in enumerate(zip(src_insts, tgt_insts)):
-                    for k, tgt in tgts.items():
-                        tgt_insts_by_k.setdefault(k, []).append(tgt)
-                        src_idxs_by_k.setdefault(k, []).append(i)
-
-                return pad_to_longest(src_insts), {
-                    k: (torch.LongTensor(src_idxs_by_k[k]).cuda(), pad_to_longest(tgt_insts_by_k[k]))
-                    for k in tgt_insts_by_k.keys()
+                # the instances of the batch which have each target
+                src_idxs_by_k = {k: np.flatnonzero(insts.valid[idxs]) for k, insts in self._tgt_insts.items()}
+
+                return pad_to_longest(self._src_insts, idxs), {
+                    k: (torch.from_numpy(src_idxs).cuda(), pad_to_longest(self._tgt_insts[k], idxs[src_idxs]))
+                    for k, src_idxs in src_idxs_by_k.items() if len(src_idxs)
                 }
 
         else:
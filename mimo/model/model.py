@@ -1,28 +1,152 @@
+import functools
+import types
+import weakref
 import torch
-import torch.nn as nn
-from torch.autograd import Variable
 
+from mimo.model.components import PAD
 from mimo.model.components.models import MimoTransformer
-from mimo.model.decode import Beam
+from mimo.model.decode import BeamSet
+
+
+def decode_step(decoder, n_words, tgt_seq, tgt_pos, src_seq, enc_kv, slf_kv):
+    """ Decode the newest target position, returning the log-probabilities and indices of its
+    n_words most likely words, along with the new cache """
+    dec_output, slf_kv = decoder.forward_with_kv(tgt_seq, tgt_pos, src_seq, enc_kv, slf_kv)
+    dec_output = dec_output.squeeze(1)  # (batch * beam) * d_model, only the newest position is decoded
+    dec_output = decoder.tgt_word_proj(dec_output).float()
+
+    # log-softmax preserves the order of the logits, so only the top words need normalising
+    word_lk, word_idxs = dec_output.topk(n_words, dim=1)
+    word_lk = word_lk - dec_output.logsumexp(dim=1, keepdim=True)
+    return word_lk, word_idxs, slf_kv
+
+
+def copy_function(fn):
+    """ Copy fn with a code object of its own, which torch.compile counts recompiles against """
+    return types.FunctionType(fn.__code__.replace(), fn.__globals__, fn.__name__, fn.__defaults__, fn.__closure__)
+
+
+def pad_batch(src_seq, src_pos, batch_inits, n_max_seq):
+    """ Pad sources to n_max_seq tokens and the batch to a power of two instances, repeating its
+    first instance """
+    n_insts, len_seq = src_seq.size()
+    n_padding = (1 << (n_insts - 1).bit_length()) - n_insts
+
+    src_seq = torch.cat([src_seq, src_seq[:1].expand(n_padding, -1)])
+    src_pos = torch.cat([src_pos, src_pos[:1].expand(n_padding, -1)])
+    batch_inits = torch.cat([batch_inits, batch_inits[:1].expand(n_padding)])
+
+    src_seq = torch.cat([src_seq, src_seq.new_full((src_seq.size(0), n_max_seq - len_seq), PAD)], 1)
+    src_pos = torch.cat([src_pos, src_pos.new_zeros(src_pos.size(0), n_max_seq - len_seq)], 1)
+    return src_seq, src_pos, batch_inits
+
+
+def bucket_active_idxs(active_inst_idxs, n_insts):
+    """ Pad the active instances with finished ones, up to a power of two instances """
+    n_bucket = min(n_insts, 1 << (len(active_inst_idxs) - 1).bit_length())
+    active = set(active_inst_idxs.tolist())
+    finished = [inst_idx for inst_idx in range(n_insts) if inst_idx not in active]
+    return active_inst_idxs.new(sorted(active.union(finished[:n_bucket - len(active)])))
+
+
+def select_active_insts(t, active_inst_idxs, n_insts, dim=0):
+    """ Select the rows of active instances from t, whose rows along dim are grouped by instance """
+    size = t.size()
+    t = t.view(*size[:dim], n_insts, size[dim] // n_insts, *size[dim + 1:])
+    return t.index_select(dim, active_inst_idxs).flatten(dim, dim + 1)
+
+
+class CapturedStep(object):
+    """ Replay a decoding step from CUDA graphs, one captured for every size of batch it is given """
+    def __init__(self, step):
+        self.step = step
+
+        # graph, inputs and outputs by the sizes of the inputs, along with weak references to the
+        # tensors last copied into the inputs
+        self.graphs = {}
+
+    @staticmethod
+    def _unflatten(inputs, layout):
+        tgt_seq, tgt_pos, src_seq, *kv = inputs
+        kv = iter(kv)
+        kv = [tuple(next(kv) for _ in range(n)) for n in layout]
+        return tgt_seq, tgt_pos, src_seq, kv[:len(kv) // 2], kv[len(kv) // 2:]
+
+    def _capture(self, inputs, layout):
+        inputs = [t.clone() for t in inputs]
+
+        # warm up on a side stream before capturing
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            self.step(*self._unflatten(inputs, layout))
+        torch.cuda.current_stream().wait_stream(stream)
+
+        graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(graph):
+            outputs = self.step(*self._unflatten(inputs, layout))
+        return graph, inputs, outputs
+
+    def __call__(self, tgt_seq, tgt_pos, src_seq, enc_kv, slf_kv):
+        inputs = [tgt_seq, tgt_pos, src_seq] + [t for kv in enc_kv + slf_kv for t in kv]
+        layout = [len(kv) for kv in enc_kv + slf_kv]
+
+        sizes = tuple(t.size() for t in inputs)
+        if sizes not in self.graphs:
+            graph, graph_inputs, outputs = self._capture(inputs, layout)
+        else:
+            graph, graph_inputs, outputs, sources = self.graphs[sizes]
+
+            # the source and encoder keys/values are the same tensors until the batch is compacted,
+            # while the self-attention keys/values are given back from the outputs of the last replay
+            n_fixed = 3 + sum(layout[:len(enc_kv)])
+            for i, (t, s) in enumerate(zip(inputs, graph_inputs)):
+                if i < 2 or i >= n_fixed or t is not sources[i]():
+                    s.copy_(t)
+
+        self.graphs[sizes] = graph, graph_inputs, outputs, [weakref.ref(t) for t in inputs]
+        graph.replay()
+        return outputs
 
 
 class GenerationModel(object):
-    def __init__(self, model, beam_size, n_best, cuda=None):
+    def __init__(self, model, beam_size, n_best, cuda=None, compact_ratio=0.5, compile_step=False,
+                 cuda_graphs=False, dtype=None):
         self.model = model
         self.cuda = torch.cuda.is_available() if cuda is None else cuda
-        self.tt = torch.cuda if self.cuda else torch
         self.beam_size = beam_size
         self.n_best = n_best
 
+        # finished instances stay in the decoded batch until fewer than this fraction are active
+        self.compact_ratio = compact_ratio
+
+        # compiled steps already use CUDA graphs in reduce-overhead mode
+        assert not (compile_step and cuda_graphs), 'Steps are either compiled or captured, not both'
+        self.compile_step = compile_step
+        self.cuda_graphs = cuda_graphs and self.cuda
+
+        # compiled and captured steps are specialised to their input sizes, so batches are padded to
+        # a power of two instances with full length sources, and are compacted to powers of two
+        self.static_shapes = self.compile_step or self.cuda_graphs
+
+        # decode under autocast to torch.float16 or torch.bfloat16, the weights are left in fp32
+        # since the model may still be training
+        self.dtype = dtype
+
         for k in model.decoders.keys():
-            prob_projection = nn.LogSoftmax(dim=1)
-            if self.cuda:
-                prob_projection.cuda()
-            else:
-                prob_projection.cpu()
-            model.decoders[k]['prob_projection'] = prob_projection
             model.decoders[k]['model'].eval()
 
+            # every decoder compiles a decode_step of its own, so that their variants are counted apart
+            step = copy_function(decode_step)
+            if compile_step:
+                step = torch.compile(step, mode='reduce-overhead' if self.cuda else None, dynamic=False)
+
+            # no more than beam_size words of any one beam can make it into the next beam
+            step = functools.partial(step, model.decoders[k]['model'], beam_size)
+            if self.cuda_graphs:
+                step = CapturedStep(step)
+            model.decoders[k]['step'] = step
+
         self.model = model
         self.model.eval()
 
@@ -63,134 +187,127 @@ class GenerationModel(object):
     def translate_batch(self, src_batch, batch_inits=None):
         results = {}
 
-        # batch size is in different location depending on data
-        for k in self.model.decoders.keys():
-            decoder = self.model.decoders[k]['model']
-
+        # matmuls run in the reduced precision, the word scores are kept in fp32 by decode_step. The
+        # weights cast in a captured graph must be cast by the graph on each replay, as autocast
+        # frees its cached casts on exit while the graphs are kept for later batches
+        autocast = torch.autocast('cuda' if self.cuda else 'cpu', dtype=self.dtype, enabled=self.dtype is not None,
+                                  cache_enabled=not self.cuda_graphs)
+        with torch.inference_mode(), autocast:
+            # batch size is in different location depending on data
             src_seq, src_pos = src_batch
-            batch_size = src_seq.size(0)
+            batch_size = n_insts = src_seq.size(0)
             beam_size = self.beam_size
             if batch_inits is None:
-                batch_inits = [int(src_seq[i][0]) for i in range(batch_size)]
+                batch_inits = src_seq[:, 0]
             else:
                 assert len(batch_inits) == batch_size
-
-            # encode
+                batch_inits = torch.as_tensor(batch_inits, device=src_seq.device)
+
+            if self.static_shapes:
+                src_seq, src_pos, batch_inits = pad_batch(
+                    src_seq, src_pos, batch_inits, self.model.encoder.n_max_seq)
+                batch_size = src_seq.size(0)
+
+            if self.compile_step:
+                # each decoder compiles a variant for every power of two instances up to batch_size
+                n_variants = batch_size.bit_length()
+                config = torch._dynamo.config
+                config.recompile_limit = max(config.recompile_limit, n_variants)
+                config.accumulated_recompile_limit = max(
+                    config.accumulated_recompile_limit, n_variants * len(self.model.decoders))
+
+            # encode once, the encoder output is shared by every decoder
             enc_output, *_ = self.model.encoder(src_seq, src_pos)
 
             # repeat data for beam
-            src_seq = Variable(
-                src_seq.data.repeat(1, beam_size).view(
-                    src_seq.size(0) * beam_size, src_seq.size(1)))
-
-            enc_output = Variable(
-                enc_output.data.repeat(1, beam_size, 1).view(
-                    enc_output.size(0) * beam_size, enc_output.size(1), enc_output.size(2)))
-
-            # prepare beams
-            beams = [Beam(beam_size, self.cuda, init=batch_inits[i]) for i in range(batch_size)]
-            beam_inst_idx_map = {
-                beam_idx: inst_idx for inst_idx, beam_idx in enumerate(range(batch_size))}
-            n_remaining_sents = batch_size
-
-            # decode
-            for i in range(decoder.n_max_seq):
-                len_dec_seq = i + 1
-
-                # preparing decoded data seq
-                # size: batch x beam x seq
-                dec_partial_seq = torch.stack([b.get_current_state() for b in beams if not b.done])
-                # size: (batch * beam) x seq
-                dec_partial_seq = dec_partial_seq.view(-1, len_dec_seq)
-                # wrap into a Variable
-                dec_partial_seq = Variable(dec_partial_seq, volatile=True)
-
-                # preparing decoded pos seq
-                # size: 1 x seq
-                dec_partial_pos = torch.arange(1, len_dec_seq + 1).unsqueeze(0)
-                # size: (batch * beam) x seq
-                dec_partial_pos = dec_partial_pos.repeat(n_remaining_sents * beam_size, 1)
-                # wrap into a Variable
-                dec_partial_pos = Variable(dec_partial_pos.type(torch.LongTensor), volatile=True)
-
-                if self.cuda:
-                    dec_partial_seq = dec_partial_seq.cuda()
-                    dec_partial_pos = dec_partial_pos.cuda()
-
-                # decoding
-                dec_output, *_ = decoder(dec_partial_seq, dec_partial_pos, src_seq, enc_output)
-                dec_output = dec_output[:, -1, :]  # (batch * beam) * d_model
-                dec_output = decoder.tgt_word_proj(dec_output)
-                out = self.model.decoders[k]['prob_projection'](dec_output)
-
-                # batch x beam x n_words
-                word_lk = out.view(n_remaining_sents, beam_size, -1).contiguous()
-
-                active_beam_idx_list = []
-                for beam_idx in range(batch_size):
-                    if beams[beam_idx].done:
+            beam_src_seq = src_seq.repeat(1, beam_size).view(src_seq.size(0) * beam_size, src_seq.size(1))
+
+            for k in self.model.decoders.keys():
+                decoder = self.model.decoders[k]['model']
+
+                # compacted as instances finish, so each decoder starts from the full batch
+                src_seq = beam_src_seq
+
+                # project the encoder output for each decoder layer once, these are reused every step
+                # size: n_head x (batch * beam) x src_seq x d
+                enc_kv = [tuple(
+                    t.repeat(1, 1, beam_size, 1).view(t.size(0), t.size(1) * beam_size, t.size(2), t.size(3))
+                    for t in kv) for kv in decoder.project_enc_kv(enc_output)]
+
+                # prepare beams
+                beams = BeamSet(beam_size, batch_inits, decoder.n_max_seq, self.cuda)
+                if batch_size > n_insts:
+                    beams.finish(torch.arange(n_insts, batch_size, device=src_seq.device))
+                n_remaining_sents = batch_size
+
+                # self-attention keys/values with a slot for every position, one (k, v) per layer
+                # size: n_head x (batch * beam) x n_max_seq x d
+                slf_kv = decoder.init_slf_kv(enc_kv)
+
+                # positions are allocated once on the decoding device and sliced at each step
+                # size: (batch * beam) x n_max_seq
+                dec_pos = torch.arange(1, decoder.n_max_seq + 1, dtype=torch.long, device=src_seq.device)
+                dec_pos = dec_pos.unsqueeze(0).expand(batch_size * beam_size, -1).contiguous()
+
+                # decode
+                # each target is decoded for at most its own n_max_seq words, its max_len plus two
+                for i in range(decoder.n_max_seq):
+                    len_dec_seq = i + 1
+
+                    # preparing the last decoded token, earlier positions are cached in slf_kv
+                    # size: (batch * beam) x 1
+                    dec_partial_seq = beams.get_current_state().view(-1, 1)
+
+                    # preparing decoded pos of the last token
+                    # size: (batch * beam) x 1
+                    dec_partial_pos = dec_pos[:n_remaining_sents * beam_size, i:len_dec_seq]
+
+                    # decoding
+                    word_lk, word_idxs, slf_kv = self.model.decoders[k]['step'](
+                        dec_partial_seq, dec_partial_pos, src_seq, enc_kv, slf_kv)
+
+                    # batch x beam x beam_size
+                    word_lk = word_lk.view(n_remaining_sents, beam_size, -1)
+                    word_idxs = word_idxs.view(n_remaining_sents, beam_size, -1)
+
+                    beam_origins, active_inst_idxs, reordered = beams.advance(word_lk, word_idxs)
+
+                    if beams.done:
+                        # all instances have finished their path to <EOS>
+                        break
+
+                    # the cached self-attention of each beam is taken from the beam it extends
+                    beam_origins = beam_origins + torch.arange(
+                        0, n_remaining_sents * beam_size, beam_size, device=beam_origins.device).unsqueeze(1)
+
+                    if len(active_inst_idxs) >= self.compact_ratio * n_remaining_sents:
+                        # finished instances are decoded along with the rest until enough have
+                        # accumulated, which saves copying the batch state on most steps
+
+                        # once their best paths settle, beams mostly extend themselves and the
+                        # cache is left where it is
+                        if reordered:
+                            slf_kv = [tuple(t.index_select(1, beam_origins.view(-1)) for t in kv) for kv in slf_kv]
                         continue
 
-                    inst_idx = beam_inst_idx_map[beam_idx]
-                    if not beams[beam_idx].advance(word_lk.data[inst_idx]):
-                        active_beam_idx_list += [beam_idx]
-
-                if not active_beam_idx_list:
-                    # all instances have finished their path to <EOS>
-                    break
-
-                # in this section, the sentences that are still active are
-                # compacted so that the decoder is not run on completed sentences
-                active_inst_idxs = self.tt.LongTensor([beam_inst_idx_map[k] for k in active_beam_idx_list])
-
-                # update the idx mapping
-                beam_inst_idx_map = {beam_idx: inst_idx for inst_idx, beam_idx in enumerate(active_beam_idx_list)}
-
-                def update_active_seq(seq_var, active_inst_idxs):
-                    """ Remove the src sequence of finished instances in one batch. """
-
-                    inst_idx_dim_size, *rest_dim_sizes = seq_var.size()
-                    inst_idx_dim_size = inst_idx_dim_size * len(active_inst_idxs) // n_remaining_sents
-                    new_size = (inst_idx_dim_size, *rest_dim_sizes)
-
-                    # select the active instances in batch
-                    original_seq_data = seq_var.data.view(n_remaining_sents, -1)
-                    active_seq_data = original_seq_data.index_select(0, active_inst_idxs)
-                    active_seq_data = active_seq_data.view(*new_size)
-
-                    return Variable(active_seq_data, volatile=True)
-
-                def update_active_enc_info(enc_info_var, active_inst_idxs):
-                    """ Remove the encoder outputs of finished instances in one batch. """
-
-                    inst_idx_dim_size, *rest_dim_sizes = enc_info_var.size()
-                    inst_idx_dim_size = inst_idx_dim_size * len(active_inst_idxs) // n_remaining_sents
-                    new_size = (inst_idx_dim_size, *rest_dim_sizes)
-
-                    # select the active instances in batch
-                    original_enc_info_data = enc_info_var.data.view(n_remaining_sents, -1, self.model.d_model)
-                    active_enc_info_data = original_enc_info_data.index_select(0, active_inst_idxs)
-                    active_enc_info_data = active_enc_info_data.view(*new_size)
-
-                    return Variable(active_enc_info_data, volatile=True)
-
-                src_seq = update_active_seq(src_seq, active_inst_idxs)
-                enc_output = update_active_enc_info(enc_output, active_inst_idxs)
-
-                # update the remaining size
-                n_remaining_sents = len(active_inst_idxs)
+                    # in this section, the sentences that are still active are
+                    # compacted so that the decoder is not run on completed sentences
+                    if self.static_shapes:
+                        active_inst_idxs = bucket_active_idxs(active_inst_idxs, n_remaining_sents)
+                    beams.compact(active_inst_idxs)
 
-            # return some useful information
-            all_hyp, all_scores = [], []
-            n_best = self.n_best
+                    beam_origins = beam_origins.index_select(0, active_inst_idxs).view(-1)
+                    slf_kv = [tuple(t.index_select(1, beam_origins) for t in kv) for kv in slf_kv]
 
-            for beam_idx in range(batch_size):
-                scores, tail_idxs = beams[beam_idx].sort_scores()
-                all_scores += [scores[:n_best]]
+                    # remove the src sequence and encoder keys/values of finished instances
+                    src_seq = select_active_insts(src_seq, active_inst_idxs, n_remaining_sents)
+                    enc_kv = [tuple(select_active_insts(t, active_inst_idxs, n_remaining_sents, dim=1) for t in kv)
+                              for kv in enc_kv]
 
-                hyps = [beams[beam_idx].get_hypothesis(i) for i in tail_idxs[:n_best]]
-                all_hyp += [hyps]
+                    # update the remaining size
+                    n_remaining_sents = len(active_inst_idxs)
 
-            results[k] = all_hyp, all_scores
+                # return some useful information
+                results[k] = tuple(r[:n_insts] for r in beams.get_n_best(self.n_best))
 
         return results
\ No newline at end of file
@@ -1,13 +1,16 @@
 import gzip
-import ujson as json
+import orjson as json
+import pyarrow as pa
 import torch
 from tqdm import tqdm
 import random
 from types import SimpleNamespace
-from itertools import chain
+from itertools import chain, islice
+from functools import partial
+from multiprocessing import Pool
 import os
 import subprocess
-from collections import Counter
+from collections import Counter, deque
 
 random.seed(1447)
 
@@ -92,7 +95,9 @@ def encode_mimo_instance(instance, max_src_len, max_inputs):
         if not mentions:
             return []
 
-        mentions = random.sample(mentions, min(max_inputs, len(mentions)))
+        # seeded by instance so that samples don't depend on which worker encodes them
+        rng = random.Random(instance['_id'])
+        mentions = rng.sample(mentions, min(max_inputs, len(mentions)))
         sources = []
         for left, span, right in mentions:
             sources.append(left + ['|'] + span + ['|'] + right)
@@ -111,7 +116,25 @@ def encode_mimo_instance(instance, max_src_len, max_inputs):
     return pairs
 
 
-def iter_read_instances(path, max_src_len, max_inputs, limit=None):
+def encode_mimo_lines(lines, max_src_len, max_inputs):
+    return [encode_mimo_instance(json.loads(line), max_src_len, max_inputs=max_inputs) for line in lines]
+
+
+def imap_ordered(fn, items, processes=None):
+    """ Map fn over items in a pool of processes, yielding results in order, items are only read
+    ahead of the results consumed by as many as will keep the processes busy """
+    processes = processes or os.cpu_count()
+    pending = deque()
+    with Pool(processes) as pool:
+        for item in items:
+            pending.append(pool.apply_async(fn, (item,)))
+            if len(pending) >= 2 * processes:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+
+def iter_read_instances(path, max_src_len, max_inputs, limit=None, processes=None, chunk_size=1024):
     print('Loading instances from:', path)
 
     total = limit
@@ -119,21 +142,24 @@ def iter_read_instances(path, max_src_len, max_inputs, limit=None):
         print('Counting lines: ' + path + '...')
         total = int(subprocess.getstatusoutput('zcat ' + path + ' | wc -l')[1].strip())
 
-    num_instances = 0
-    with gzip.open(path) as f:
-        for line in tqdm(f, total=total):
-            num_instances += 1
-            for iid, src, tgt in encode_mimo_instance(json.loads(line), max_src_len, max_inputs=max_inputs):
-                yield iid, src, tgt
-            if limit is not None and num_instances >= limit:
-                break
+    # lines are decompressed here and parsed and encoded by a pool in chunks, results are
+    # yielded in the order of the file so that the pairs of an instance stay together
+    encode = partial(encode_mimo_lines, max_src_len=max_src_len, max_inputs=max_inputs)
+    with gzip.open(path) as f, tqdm(total=total) as progress:
+        lines = islice(f, limit)
+        chunks = iter(lambda: list(islice(lines, chunk_size)), [])
 
+        # a pool is only worth starting for more than one chunk
+        encoded_chunks = map(encode, chunks) if total <= chunk_size else imap_ordered(encode, chunks, processes)
+        for instances in encoded_chunks:
+            progress.update(len(instances))
+            for pairs in instances:
+                yield from pairs
 
-def build_vocab_idx(word_insts, min_word_count):
-    full_vocab = set(w for sent in word_insts for w in sent)
-    print('[Info] Original Vocabulary size =', len(full_vocab))
 
-    word_count = {w: 0 for w in full_vocab}
+def build_vocab_idx(word_insts, min_word_count):
+    word_count = Counter(w for sent in word_insts for w in sent)
+    print('[Info] Original Vocabulary size =', len(word_count))
 
     word2idx = {
         BOS_WORD: BOS,
@@ -144,10 +170,6 @@ def build_vocab_idx(word_insts, min_word_count):
     #for i, k in enumerate(target_config.keys()):
     #    word2idx[k] = max(word2idx.values()) + 1
 
-    for sent in word_insts:
-        for word in sent:
-            word_count[word] += 1
-
     ignored_word_count = 0
     for word, count in word_count.items():
         if word not in word2idx:
@@ -170,6 +192,45 @@ def convert_mimo_instances_to_idx_seq(instances, word2idx):
     return [{k: [word2idx[k][w] if w in word2idx[k] else UNK for w in s] for k, s in inst.items()} for inst in instances]
 
 
+def get_split_path(path, split):
+    return os.path.splitext(path)[0] + '.' + split + '.arrow'
+
+
+def save_dataset(data, path):
+    """ Save the vocabularies and settings to path, and each split to an arrow file alongside it """
+    torch.save({'settings': data['settings'], 'dict': data['dict']}, path)
+
+    list_type = pa.list_(pa.int32())
+    for split in ['train', 'valid']:
+        # one column of sequences per target, null for instances without that target
+        columns = {'src': pa.array(data[split]['src'], type=list_type)}
+        for k in target_config.keys():
+            columns[k] = pa.array([inst.get(k) for inst in data[split]['tgt']], type=list_type)
+
+        table = pa.table(columns)
+        with pa.OSFile(get_split_path(path, split), 'wb') as f, pa.ipc.new_file(f, table.schema) as writer:
+            writer.write_table(table)
+
+
+def load_dataset(path):
+    """ Load a dataset saved by save_dataset, with the splits as arrow arrays mapped from their files
+
+    The sequences of a split are a list<int32> array of sources and a dict of arrays of targets, which
+    MimoDataLoader pads a batch at a time. Datasets saved whole by torch.save are loaded as they are.
+    """
+    data = torch.load(path)
+    if 'train' in data:
+        return data
+
+    for split in ['train', 'valid']:
+        table = pa.ipc.open_file(pa.memory_map(get_split_path(path, split))).read_all()
+        data[split] = {
+            'src': table.column('src'),
+            'tgt': {k: table.column(k) for k in table.column_names if k != 'src'}
+        }
+    return data
+
+
 params = {
     'train_path': 'train.jsonl.gz',
     'valid_path': 'dev.jsonl.gz',
@@ -248,6 +309,6 @@ def main():
         }
     }
 
-    print('[Info] Dumping the processed data to pickle file', opt.save_data)
-    torch.save(data, opt.save_data)
+    print('[Info] Dumping the processed data to', opt.save_data)
+    save_dataset(data, opt.save_data)
     print('[Info] Finish.')
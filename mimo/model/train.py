@@ -15,7 +15,7 @@ from mimo.model.components import PAD
 from mimo.model.model import MimoTransformer
 from mimo.model.loader import MimoDataLoader
 from mimo.model.components.optim import ScheduledOptim
-from mimo.model.preprocess import target_config
+from mimo.model.preprocess import target_config, load_dataset
 from mimo.model.model import GenerationModel
 from mimo.evaluate import iter_instance_decodes, evaluate_decodes, get_summary_metrics
 
@@ -249,10 +249,10 @@ def main():
     opt = SimpleNamespace(**params)
 
     # prepare data
-    data = torch.load(opt.data)
+    data = load_dataset(opt.data)
     opt.max_token_src_seq_len = data['settings'].max_token_src_seq_len
 
-    print('inst', data['train']['tgt'][0])
+    print('Instances:', {split: len(data[split]['src']) for split in ['train', 'valid']})
 
     training_data = MimoDataLoader(
         data['dict']['src'],
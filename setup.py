@@ -25,6 +25,8 @@ setup(
         "numpy",
         "scipy",
         "ujson",
+        "orjson",
+        "pyarrow",
         "spacy",
         "tqdm",
         "pytorch"